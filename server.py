@@ -1,164 +1,441 @@
 import os
+import sys
 import asyncio
+import socket
+import logging
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
 import websockets
-import hashlib
+from websockets.frames import Opcode
+from websockets.protocol import State
+import struct
 import time
+from dataclasses import dataclass, field
 
 PORT = int(os.environ.get("PORT", 8080))
+# Buffer di invio per socket in byte; 0 lascia al kernel l'autotuning (impostarlo lo disattiva)
+SEND_BUFFER_SIZE = int(os.environ.get("SEND_BUFFER_SIZE", 0))
 
-clients = {}             # websocket -> nickname
-client_keys = {}         # nickname -> chiave pubblica PEM
-nickname_to_ws = {}      # nickname -> websocket attuale
-recent_messages = set()
+clients = {}             # websocket -> Client
+clients_by_nick = {}     # nickname -> Client attuale
+published_keys = 0       # client connessi che hanno inviato una chiave pubblica
+recent_messages = set()    # hash dei messaggi della finestra corrente
+previous_messages = set()  # hash della finestra precedente
+rotation_at = 0.0          # istante in cui la finestra corrente diventa la precedente
 MESSAGE_CACHE_TIME = 60  # secondi per mantenere l'ID del messaggio
+DEDUP_MAX = 100_000      # voci massime nella cache dei duplicati (due finestre insieme)
 busy_users = {}  # chiave = destinatario, valore = chi ha aperto la chat
+closing_tasks = set()    # chiusure in corso: asyncio tiene solo riferimenti deboli ai task
+OUTGOING_QUEUE_SIZE = 256  # messaggi in attesa oltre i quali il client è troppo lento
+BATCH_MAX_BYTES = 64 * 1024  # byte massimi raggruppati in una singola scrittura
+SEND_TIMEOUT = 10         # secondi di attesa massima per svuotare il buffer di invio di un client
+ERROR_LOG_RATE = 5       # errori di parsing registrati al secondo per client
+ERROR_LOG_BURST = 10     # errori registrabili di fila prima del limite
+MAX_MESSAGE_SIZE = 64 * 1024  # byte massimi per messaggio in arrivo, oltre il client viene chiuso
+LISTEN_BACKLOG = 4096    # connessioni in attesa di accept prima che il kernel le rifiuti
+
+# Testi fissi già codificati: per ogni evento si codifica solo il nickname
+CONNECTED_NOTICE = "[Sistema] L'utente %s si è connesso!".encode()
+DISCONNECTED_NOTICE = "[Sistema] L'utente %s si è disconnesso!".encode()
+BUSY_REPLY = b"[BUSY]:%s"
+FREE_REPLY = b"[FREE]:%s"
+
+logger = logging.getLogger("railway")
+
+
+def start_logging():
+    """Scrive i log da un thread a parte: l'event loop non aspetta mai stdout"""
+    log_queue = SimpleQueue()
+    stream = logging.StreamHandler(sys.stdout)
+    stream.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(QueueHandler(log_queue))
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    listener = QueueListener(log_queue, stream)
+    listener.start()
+    return listener
+
+
+# Intestazioni dei frame server -> client (senza maschera), una per fascia di lunghezza
+TEXT_FRAME_FIN = 0x80 | Opcode.TEXT
+HEADER_7BIT = struct.Struct("!BB")
+HEADER_16BIT = struct.Struct("!BBH")
+HEADER_64BIT = struct.Struct("!BBQ")
+
+
+class TokenBucket:
+    """Limitatore a gettoni: al massimo burst eventi di fila, ricaricati a rate al secondo"""
+    __slots__ = ("rate", "burst", "tokens", "last")
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+
+    def allow(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+@dataclass(slots=True)
+class Client:
+    """Tutto lo stato di una connessione in un solo oggetto"""
+    ws: object
+    nickname: str
+    queue: asyncio.Queue | None  # uno o più frame già serializzati per elemento, None se il client è stato scartato
+    error_budget: TokenBucket
+    writer: asyncio.Task | None = None  # task che svuota la coda
+    key_frame: bytes | None = None  # frame [PUBKEY] già pronto
+    chats_opened: set = field(default_factory=set)  # destinatari che questo client ha segnato come occupati
 
 
 async def disconnect_client(websocket, notify=True):
-    nickname = clients.pop(websocket, None)
-    if nickname:
-        nickname_to_ws.pop(nickname, None)
-        client_keys.pop(nickname, None)
+    global published_keys
+    client = clients.pop(websocket, None)
+    if client:
+        if client.key_frame:
+            published_keys -= 1
+        if client.writer:
+            client.writer.cancel()
+        client.queue = None
+        nickname = client.nickname
+        if clients_by_nick.get(nickname) is client:
+            clients_by_nick.pop(nickname)
+        # Chiude solo le chat private che coinvolgono il client, senza scorrere busy_users
+        for dest_nick in client.chats_opened:
+            if busy_users.get(dest_nick) == nickname:
+                del busy_users[dest_nick]
+        opener = clients_by_nick.get(busy_users.pop(nickname, None))
+        if opener:
+            opener.chats_opened.discard(nickname)
         if notify:
-            for client in clients:
-                try:
-                    await safe_send(client, f"[Sistema] L'utente {nickname} si è disconnesso!")
-                except:
-                    continue
-        print(f"[Sistema] Client {nickname} disconnesso. Client totali: {len(clients)}")
+            broadcast(DISCONNECTED_NOTICE % nickname.encode())
+        logger.info("[Sistema] Client %s disconnesso. Client totali: %d", nickname, len(clients))
 
 
-async def cleanup_message_cache():
-    """Rimuove vecchi messaggi dal set dei duplicati"""
-    while True:
-        now = time.time()
-        to_remove = {m for m in recent_messages if now - m[1] > MESSAGE_CACHE_TIME}
-        for m in to_remove:
-            recent_messages.discard(m)
-        await asyncio.sleep(10)
-
-
-async def safe_send(client, message):
-    """Invio sicuro con retry su eventuali errori temporanei"""
-    for _ in range(3):
-        try:
-            await client.send(message)
-            return True
-        except websockets.ConnectionClosed:
-            await asyncio.sleep(0.1)
+def seen_recently(msg_hash):
+    """Registra l'hash e dice se era già stato visto di recente:
+    un hash resta in cache almeno MESSAGE_CACHE_TIME secondi e al massimo il doppio,
+    tranne quando la finestra corrente arriva a DEDUP_MAX // 2 voci e ruota in anticipo
+    (sotto un flusso molto intenso un hash può sparire ben prima di MESSAGE_CACHE_TIME)"""
+    global recent_messages, previous_messages, rotation_at
+    now = time.monotonic()
+    # Due finestre a rotazione: la scadenza costa un solo scambio
+    # invece di un controllo per voce
+    if now >= rotation_at + MESSAGE_CACHE_TIME:
+        # Entrambe le finestre sono scadute: si riparte da capo
+        previous_messages = set()
+        recent_messages = set()
+        rotation_at = now + MESSAGE_CACHE_TIME
+    elif now >= rotation_at or len(recent_messages) >= DEDUP_MAX // 2:
+        previous_messages = recent_messages
+        recent_messages = set()
+        if now >= rotation_at:
+            rotation_at += MESSAGE_CACHE_TIME  # confini fissi, non legati all'ultima chiamata
+    if msg_hash in recent_messages or msg_hash in previous_messages:
+        return True
+    recent_messages.add(msg_hash)
     return False
 
 
+def frame_text(data):
+    """Costruisce il frame di testo completo (senza maschera) per i byte UTF-8 dati"""
+    length = len(data)
+    if length < 126:
+        header = HEADER_7BIT.pack(TEXT_FRAME_FIN, length)
+    elif length < 65536:
+        header = HEADER_16BIT.pack(TEXT_FRAME_FIN, 126, length)
+    else:
+        header = HEADER_64BIT.pack(TEXT_FRAME_FIN, 127, length)
+    return header + data
+
+
+def broadcast(data, exclude=None):
+    """Accoda lo stesso frame, costruito una sola volta, per tutti i client tranne exclude"""
+    # exclude è sempre un client registrato (il mittente)
+    if len(clients) - (exclude is not None) <= 0:
+        return  # nessuno da raggiungere: inutile costruire il frame
+    broadcast_frame(frame_text(data), exclude)
+
+
+def broadcast_frame(frame, exclude=None):
+    """Accoda un frame già pronto per tutti i client tranne exclude"""
+    # Con compression=None il frame è identico per ogni destinatario
+    targets = [client for client in clients.values() if client is not exclude]
+    for client in targets:
+        put_frame(client, frame)
+
+
+def enqueue(client, data):
+    """Mette un messaggio già codificato nella coda del client senza attendere l'invio"""
+    return put_frame(client, frame_text(data))
+
+
+def close_later(websocket, code, reason):
+    """Chiude la connessione in background senza perdere il riferimento al task"""
+    task = asyncio.create_task(websocket.close(code, reason))
+    closing_tasks.add(task)
+    task.add_done_callback(closing_tasks.discard)
+
+
+def put_frame(client, frame):
+    """Mette un frame già pronto nella coda del client"""
+    queue = client.queue
+    if queue is None:
+        return False
+    try:
+        queue.put_nowait(frame)
+        return True
+    except asyncio.QueueFull:
+        # Client troppo lento: smette di ricevere e viene chiuso,
+        # la pulizia la fa il finally di handler
+        client.queue = None
+        logger.warning("[Sistema] Client %s troppo lento, chiusura connessione", client.nickname)
+        close_later(client.ws, 1008, "Client troppo lento")
+        return False
+
+
+async def writer_loop(client):
+    """Unico task di scrittura per client: invia i messaggi accodati in ordine"""
+    queue = client.queue
+    while True:
+        batch = [await queue.get()]
+        size = len(batch[0])
+        # Raggruppa i messaggi già in coda per scriverli tutti in una volta
+        while not queue.empty() and size < BATCH_MAX_BYTES:
+            frame = queue.get_nowait()
+            batch.append(frame)
+            size += len(frame)
+        if not await send_batch(client, batch):
+            break
+    # Nessuno svuota più la coda: i broadcast successivi la salteranno
+    client.queue = None
+
+
+async def send_batch(client, batch):
+    """Scrive più frame già pronti con un'unica write sul socket"""
+    websocket = client.ws
+    if websocket.protocol.state is not State.OPEN:
+        return False
+    # I frame vanno direttamente sul transport, senza passare da send():
+    # ogni messaggio resta un frame separato, i client non vedono differenze
+    websocket.transport.writelines(batch)
+    try:
+        # Solo un timer sul task corrente: nessun task in più per ogni invio
+        async with asyncio.timeout(SEND_TIMEOUT):
+            await websocket.drain()
+    except TimeoutError:
+        # Il client non legge più: il buffer resterebbe pieno all'infinito.
+        # Se put_frame l'ha già scartato, la chiusura è già in corso
+        if client.queue is not None:
+            client.queue = None
+            logger.warning("[Sistema] Invio bloccato verso %s, chiusura connessione", client.nickname)
+            close_later(websocket, 1008, "Client troppo lento")
+        return False
+    except OSError:  # dopo TimeoutError, che ne è una sottoclasse
+        # Connessione resettata mentre il buffer era pieno: la pulizia la fa il finally di handler
+        return False
+    return True
+
+
+# --- Chiave pubblica ---
+def handle_pubkey(client, message):
+    global published_keys
+    try:
+        header, pem = message.split("\n", 1)
+        nick_from_key = header[len("[PUBKEY]"):].strip()
+        # Il frame della chiave si costruisce una volta e si riusa
+        # per tutti i client che si collegheranno dopo
+        key_frame = frame_text(f"[PUBKEY]{nick_from_key}\n{pem}".encode())
+        if key_frame == client.key_frame:
+            return  # stessa chiave ripubblicata: gli altri ce l'hanno già
+        first_key = client.key_frame is None
+        client.key_frame = key_frame
+        if first_key:
+            published_keys += 1
+        logger.info("[Sistema] Chiave pubblica ricevuta da %s. Totale chiavi: %d", nick_from_key, published_keys)
+
+        # Invia la chiave pubblica solo agli altri client
+        broadcast_frame(client.key_frame, exclude=client)
+
+        if not first_key:
+            return  # le chiavi degli altri sono già state inviate
+
+        # Invia tutte le chiavi esistenti al nuovo client in un solo elemento
+        # della coda: restano frame separati, ma non riempiono la coda uno per uno
+        history = b"".join(
+            other.key_frame for other in clients.values()
+            if other.key_frame and other is not client
+        )
+        if history:
+            put_frame(client, history)
+
+    except Exception as e:
+        if client.error_budget.allow():
+            logger.error("[Errore parsing PUBKEY]: %s", e)
+
+
+# --- Messaggio DM cifrato ---
+def handle_dm(client, message):
+    try:
+        _, rest = message.split(":", 1)
+        dest_nick, payload_b64 = rest.split(":", 1)
+        dest_nick = dest_nick.strip()
+        sender_nick = client.nickname
+
+        # Controlla se il destinatario è già in chat con un altro
+        if dest_nick in busy_users and busy_users[dest_nick] != sender_nick:
+            enqueue(client, BUSY_REPLY % dest_nick.encode())
+            return
+
+        # Segna destinatario come occupato con questo mittente
+        busy_users[dest_nick] = sender_nick
+        client.chats_opened.add(dest_nick)
+
+        # Invia DM solo al destinatario
+        dest = clients_by_nick.get(dest_nick)
+        if dest:
+            dm_message = f"[DM]:{sender_nick}:{payload_b64}"
+            enqueue(dest, dm_message.encode())
+
+    except Exception as e:
+        if client.error_budget.allow():
+            logger.error("[Errore DM]: %s", e)
+
+
+# --- Fine chat privata ---
+def handle_end_chat(client, message):
+    ended_nick = message[len("[END_CHAT]:"):].strip()
+    # Rimuovi solo se il mittente corrisponde
+    if busy_users.get(ended_nick) == client.nickname:
+        busy_users.pop(ended_nick)
+        client.chats_opened.discard(ended_nick)
+
+
+# --- Controllo disponibilità ---
+def handle_check_busy(client, message):
+    dest_nick = message[len("[CHECK_BUSY]:"):].strip()
+    if dest_nick in busy_users:
+        enqueue(client, BUSY_REPLY % dest_nick.encode())
+    else:
+        enqueue(client, FREE_REPLY % dest_nick.encode())
+
+
+# --- Messaggi broadcast legacy ---
+def handle_broadcast(client, message):
+    if len(clients) <= 1:
+        return  # nessun altro da raggiungere: inutile calcolare l'hash
+    # Basta un hash non crittografico: la cache serve solo a scartare
+    # i duplicati recenti su questa istanza
+    if not seen_recently(hash(message)):
+        broadcast(message.encode(), exclude=client)
+
+
+# Prefisso del comando -> funzione che lo gestisce
+COMMANDS = {
+    "[PUBKEY]": handle_pubkey,
+    "[DM]:": handle_dm,
+    "[END_CHAT]:": handle_end_chat,
+    "[CHECK_BUSY]:": handle_check_busy,
+}
+
+
+# Il tag più lungo è "[CHECK_BUSY]": oltre questa posizione non si cerca la "]"
+COMMAND_TAG_MAX = max(len(prefix) for prefix in COMMANDS)
+
+
+def find_command(message):
+    """Sceglie la funzione per il messaggio con un solo lookup sul prefisso"""
+    if not message.startswith("["):
+        return handle_broadcast
+    end = message.find("]", 1, COMMAND_TAG_MAX) + 1
+    # Il prefisso può includere i ":" subito dopo la parentesi ("[DM]:") oppure no ("[PUBKEY]")
+    return COMMANDS.get(message[:end + 1]) or COMMANDS.get(message[:end], handle_broadcast)
+
+
+def tune_socket(websocket):
+    """Opzioni TCP sul socket accettato: frame piccoli subito in rete, buffer di invio su misura"""
+    sock = websocket.transport.get_extra_info("socket")
+    if sock is None:
+        return
+    # asyncio e uvloop lo impostano già: lo si rende esplicito per non dipendere dal loop
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    if SEND_BUFFER_SIZE:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SEND_BUFFER_SIZE)
+
+
 async def handler(websocket):
+    tune_socket(websocket)
     try:
-        nickname = await websocket.recv()
-        old_ws = nickname_to_ws.get(nickname)
-        if old_ws:
-            await disconnect_client(old_ws, notify=True)
+        # Una sola copia del nickname per tutta la connessione: chiavi e valori
+        # di clients_by_nick e busy_users puntano allo stesso oggetto
+        nickname = sys.intern(await websocket.recv())
+        old = clients_by_nick.get(nickname)
+        if old:
+            await disconnect_client(old.ws, notify=True)
+            # La vecchia connessione non deve restare aperta a nome del nickname
+            close_later(old.ws, 1000, "Sostituito da una nuova connessione")
 
-        clients[websocket] = nickname
-        nickname_to_ws[nickname] = websocket
-        print(f"[Sistema] Nuovo client connesso: {nickname}. Client totali: {len(clients)}")
+        queue = asyncio.Queue(maxsize=OUTGOING_QUEUE_SIZE)
+        # Un client che manda solo spazzatura non deve intasare i log
+        error_budget = TokenBucket(ERROR_LOG_RATE, ERROR_LOG_BURST)
+        client = Client(websocket, nickname, queue, error_budget)
+        client.writer = asyncio.create_task(writer_loop(client))
+        clients[websocket] = client
+        clients_by_nick[nickname] = client
+        logger.info("[Sistema] Nuovo client connesso: %s. Client totali: %d", nickname, len(clients))
 
         # Notifica tutti gli altri utenti
-        for client in clients:
-            if client != websocket:
-                await safe_send(client, f"[Sistema] L'utente {nickname} si è connesso!")
+        broadcast(CONNECTED_NOTICE % nickname.encode(), exclude=client)
 
         # Ascolto dei messaggi
         async for message in websocket:
-            # --- Chiave pubblica ---
-            if message.startswith("[PUBKEY]"):
-                try:
-                    header, pem = message.split("\n", 1)
-                    nick_from_key = header[len("[PUBKEY]"):].strip()
-                    client_keys[nick_from_key] = pem
-                    print(f"[Sistema] Chiave pubblica ricevuta da {nick_from_key}. Totale chiavi: {len(client_keys)}")
-
-                    # Invia la chiave pubblica solo agli altri client
-                    for client, nick in clients.items():
-                        if client != websocket:
-                            await safe_send(client, message)
-
-                    # Invia tutte le chiavi esistenti al nuovo client
-                    for other_nick, key_pem in client_keys.items():
-                        if other_nick != nick_from_key:
-                            await safe_send(websocket, f"[PUBKEY]{other_nick}\n{key_pem}")
-
-                except Exception as e:
-                    print(f"[Errore parsing PUBKEY]: {e}")
-                continue
-
-            # --- Messaggio DM cifrato ---
-            elif message.startswith("[DM]:"):
-                try:
-                    _, rest = message.split(":", 1)
-                    dest_nick, payload_b64 = rest.split(":", 1)
-                    dest_nick = dest_nick.strip()
-                    sender_nick = clients.get(websocket, "unknown")
-            
-                    # Controlla se il destinatario è già in chat con un altro
-                    if dest_nick in busy_users and busy_users[dest_nick] != sender_nick:
-                        await safe_send(websocket, f"[BUSY]:{dest_nick}")
-                        continue
-            
-                    # Segna destinatario come occupato con questo mittente
-                    busy_users[dest_nick] = sender_nick
-            
-                    # Invia DM solo al destinatario
-                    dest_ws = nickname_to_ws.get(dest_nick)
-                    if dest_ws:
-                        dm_message = f"[DM]:{sender_nick}:{payload_b64}"
-                        await safe_send(dest_ws, dm_message)
-            
-                except Exception as e:
-                    print(f"[Errore DM]: {e}")
-
-            # --- Fine chat privata ---
-            elif message.startswith("[END_CHAT]:"):
-                ended_nick = message[len("[END_CHAT]:"):].strip()
-                sender_nick = clients.get(websocket, "unknown")
-                # Rimuovi solo se il mittente corrisponde
-                if busy_users.get(ended_nick) == sender_nick:
-                    busy_users.pop(ended_nick)
-
-            # --- Controllo disponibilità ---
-            elif message.startswith("[CHECK_BUSY]:"):
-                dest_nick = message[len("[CHECK_BUSY]:"):].strip()
-                if dest_nick in busy_users:
-                    await safe_send(websocket, f"[BUSY]:{dest_nick}")
-                else:
-                    await safe_send(websocket, f"[FREE]:{dest_nick}")
-
-            # --- Messaggi broadcast legacy ---
-            else:
-                msg_hash = hashlib.sha256(message.encode()).hexdigest()
-                if msg_hash not in {m[0] for m in recent_messages}:
-                    for client in clients:
-                        if client != websocket:
-                            await safe_send(client, message)
-                    recent_messages.add((msg_hash, time.time()))
+            # Cede il controllo ai writer: una raffica di frame già ricevuti
+            # verrebbe altrimenti elaborata tutta prima di qualsiasi invio
+            await asyncio.sleep(0)
+            if clients.get(websocket) is not client:
+                break  # sostituito da un'altra connessione con lo stesso nickname
+            find_command(message)(client, message)
 
     except websockets.ConnectionClosed:
         pass
     except Exception as e:
-        print(f"[Errore] {e}")
+        logger.error("[Errore] %s", e)
     finally:
         await disconnect_client(websocket)
 
 
 async def main():
-    asyncio.create_task(cleanup_message_cache())
     async with websockets.serve(
         handler,
         "0.0.0.0",
         PORT,
+        compression=None,  # niente deflate per connessione: ogni broadcast verrebbe ricompresso N volte
         ping_interval=30,
-        ping_timeout=30
+        ping_timeout=30,
+        max_size=MAX_MESSAGE_SIZE,
+        backlog=LISTEN_BACKLOG
     ):
-        print(f"[Sistema] Server WebSocket avviato sulla porta {PORT}")
+        logger.info("[Sistema] Server WebSocket avviato sulla porta %d", PORT)
         await asyncio.Future()  # rimane in attesa infinita
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    listener = start_logging()
+    # uvloop se disponibile, altrimenti l'event loop standard
+    try:
+        import uvloop
+    except ImportError:
+        run = asyncio.run
+    else:
+        run = uvloop.run
+    try:
+        run(main())
+    finally:
+        listener.stop()  # svuota i log rimasti in coda